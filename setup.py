@@ -1,8 +1,11 @@
 import setuptools
 
 REQUIRED_PACKAGES = [
+    "cachetools==5.5.0",
+    "msgspec==0.18.6",
     "pytest==6.2.5",
     "requests==2.26.0",
+    "requests-cache==1.2.1",
 ]
 
 setuptools.setup(
@@ -3,12 +3,20 @@ import logging
 import logging.config
 import operator
 import sys
-from collections import namedtuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from pprint import pp
 from traceback import print_exc, print_last, print_stack
+from typing import Any
 
+import msgspec
 import requests
+import requests_cache
+from cachetools import TTLCache, cachedmethod
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 logging.basicConfig(level=logging.WARN, format="%(asctime)s %(levelname)s %(message)s")
 try:
@@ -19,7 +27,42 @@ except FileNotFoundError as e:
 logger = logging.getLogger("smhi")
 
 
-StationTemp = namedtuple("StationTemp", ["key", "name", "temp", "station"])
+class StationRow(msgspec.Struct):
+    # station entry in https://opendata-download-metobs.smhi.se/api/version/1.0/parameter/2.json
+    key: str
+    updated: int  # milliseconds since the epoch
+    name: str = "N/A"
+
+
+class StationList(msgspec.Struct):
+    station: list[StationRow]
+
+
+class StationInfo(msgspec.Struct):
+    key: str
+    name: str = "N/A"
+
+
+class Observation(msgspec.Struct):
+    value: str | None = None
+
+
+class StationData(msgspec.Struct):
+    # https://opendata-download-metobs.smhi.se/api/version/1.0/parameter/2/station/188790/period/latest-day/data.json
+    station: StationInfo
+    value: list[Observation] | None = None
+
+
+@dataclass(slots=True, frozen=True)
+class StationTemp:
+    key: int  # numeric station key, used to break ties
+    name: str
+    temp: float
+    station: StationInfo
+
+
+# Number of stations fetched concurrently
+MAX_WORKERS = 32
 
 
 class SmhiParser:
@@ -28,16 +71,76 @@ class SmhiParser:
     """
 
     BASE_URL = "https://opendata-download-metobs.smhi.se/api"
+    PARAMETERS_PATH = "/version/1.0.json"
+    STATIONS_PATH = "/version/1.0/parameter/2.json"
+    STATION_DATA_PATH = (
+        "/version/1.0/parameter/2/station/{}/period/latest-day/data.json"
+    )
+    # Observations are published hourly, responses are kept on disk
+    # (~/.cache/smhi.sqlite) for this many seconds
+    CACHE_EXPIRE_AFTER = 600
+    # (connect, read) timeouts in seconds, so a hung station can't block the scan
+    TIMEOUT = (2, 5)
 
-    def __init__(self, suffix=".json"):
-        self.suffix = suffix
+    def __init__(self, cache_name="smhi", cache_backend="sqlite"):
+        # Responses are cached with a TTL, if SMHI is down we fall back to
+        # the stale cached responses. Expired responses are revalidated with
+        # If-None-Match/If-Modified-Since, so an unchanged station list comes
+        # back as a 304 without a body. Use cache_backend="memory" to keep
+        # the cache out of the user's cache dir (e.g. in tests)
+        self.session = requests_cache.CachedSession(
+            cache_name,
+            backend=cache_backend,
+            use_cache_dir=True,
+            expire_after=self.CACHE_EXPIRE_AFTER,
+            cache_control=True,
+            stale_if_error=True,
+        )
+        # Reuse connections (keep-alive) across requests, all requests go to
+        # the same host so a single pool big enough for all workers is enough
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=MAX_WORKERS,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods={"GET"},
+                # once the retries run out return the last response instead
+                # of raising, so the station is skipped by the status check
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("https://", adapter)
+        # Decoded responses are also memoized in memory for a short time, so
+        # repeated calls in the same process skip the request and the decoding
+        self._json_cache = TTLCache(maxsize=1024, ttl=60)
+        self._json_lock = threading.Lock()  # the cache is shared by the workers
 
-    def _make_request(self, path=""):
-        r = requests.get(self.BASE_URL + path + self.suffix)
+    def _make_request(self, path):
+        r = self.session.get(self.BASE_URL + path, timeout=self.TIMEOUT)
         return r
 
+    @cachedmethod(
+        operator.attrgetter("_json_cache"), lock=operator.attrgetter("_json_lock")
+    )
+    def _get_json(self, path, decode_type=Any):
+        # Returns the decoded response. The value is shared through the cache,
+        # callers must not modify it. Failed requests raise (and so are not
+        # cached)
+        r = self._make_request(path=path)
+        if r.status_code != 200:
+            raise requests.HTTPError(
+                f"URL {r.url} returned status code {r.status_code}", response=r
+            )
+        return msgspec.json.decode(r.content, type=decode_type)
+
     def check_connection(self):
-        r = self._make_request()
+        # https://opendata-download-metobs.smhi.se/api.json
+        # always hit SMHI, a cached (or stale) response says nothing about
+        # the connection
+        with self.session.cache_disabled():
+            r = self._make_request(path=".json")
         return r.status_code
 
     def print(self, *args, **kwargs):  # makes testing easier
@@ -45,40 +148,59 @@ class SmhiParser:
 
     def parameters(self):
         # https://opendata-download-metobs.smhi.se/api/version/1.0.json
-        r = self._make_request(path="/version/1.0")
-
-        params = sorted(r.json()["resource"], key=lambda x: int(x["key"]))
+        # sorted() copy, the decoded response is shared through the cache
+        params = sorted(
+            self._get_json(path=self.PARAMETERS_PATH)["resource"],
+            key=lambda x: int(x["key"]),
+        )
         # logger.debug("params %s", params)
-        for param in params:
-            # 1, Lufttemperatur (momentanvärde, 1 gång/tim)
-            print(f"{param['key']:>3}, {param['title']} ({param['summary']})")
-            # logger.debug(f"{param['key']:>3}, {param['title']} ({param['summary']})")
+        # 1, Lufttemperatur (momentanvärde, 1 gång/tim)
+        # build the whole listing and write it to stdout in one go
+        self.print(
+            "\n".join(
+                f"{param['key']:>3}, {param['title']} ({param['summary']})"
+                for param in params
+            )
+        )
 
     def get_station_data(self, station):
         # https://opendata-download-metobs.smhi.se/api/version/1.0/parameter/2/station/188790.json
         # https://opendata-download-metobs.smhi.se/api/version/1.0/parameter/2/station/188790/period/latest-day.json
         # https://opendata-download-metobs.smhi.se/api/version/1.0/parameter/2/station/188790/period/latest-day/data.json
-        station_key = station["key"]
-        r = self._make_request(
-            path=f"/version/1.0/parameter/2/station/{station_key}/period/latest-day/data"
-        )
-        if r.status_code != 200:  # TODO: How shall we handle 404, etc
-            logger.debug("URL %s returned status code %s", r.url, r.status_code)
+        try:
+            r = self._get_json(
+                path=self.STATION_DATA_PATH.format(station.key), decode_type=StationData
+            )
+        except requests.HTTPError as e:
+            # 404, etc, the station has no data for the period
+            logger.debug("Can't fetch data for station %s: %s", station.name, e)
+            return None
+        except requests.RequestException as e:
+            # timeouts, connection errors, etc
+            logger.warning("Can't fetch data for station %s: %s", station.name, e)
+            return None
+        except msgspec.DecodeError as e:
+            # malformed JSON, or JSON that doesn't match StationData
+            logger.warning("Unexpected data for station %s: %s", station.name, e)
             return None
-        r = r.json()
-        station_name = r["station"]["name"]
         try:
-            station_temp = float(r["value"][0]["value"])
-        except:
-            # TODO: better error handling
+            station_temp = float(r.value[0].value)
+        except (TypeError, IndexError, ValueError):
             # value can be missing, be an empty list, the first eleemnt in the list may be missing 'value', or value can't be parsed as float
-            logger.warning("Can't get temperature for station %s", station_name)
+            logger.warning("Can't get temperature for station %s", r.station.name)
+            return None
+        try:
+            station_key = int(r.station.key)
+        except ValueError:
+            logger.warning(
+                "Unexpected key %r for station %s", r.station.key, r.station.name
+            )
             return None
         station_data = StationTemp(
-            key=r["station"]["key"],
-            name=station_name,
+            key=station_key,
+            name=r.station.name,
             temp=station_temp,
-            station=r["station"],
+            station=r.station,
         )
         logger.info("station %s", station_data)
         return station_data
@@ -92,49 +214,44 @@ class SmhiParser:
         # So we need to loop over all the stations and fetch the data for each
         # we should check the updated field of each station
 
-        version = "1.0"
-        parameter = "2"
-
-        r = self._make_request(path=f"/version/{version}/parameter/{parameter}")
-
-        stations = r.json()["station"]
+        # without the station list there is nothing to report, let it raise
+        stations = self._get_json(
+            path=self.STATIONS_PATH, decode_type=StationList
+        ).station
 
-        # We sort the stations so that we have an stable order, to break
-        # ties when several stations ties on min,max temperatures
-        stations = sorted(stations, key=lambda x: x["key"])
-
-        now = datetime.now(timezone.utc)
-        min_station = StationTemp(
-            key=None, temp=float("+inf"), name="N/A", station=None
+        # TODO check if ignoring data older than 2 days is ok
+        # updated is in milliseconds since the epoch
+        cutoff_ms = int(
+            (datetime.now(timezone.utc) - timedelta(days=2)).timestamp() * 1000
         )
-        max_station = StationTemp(
-            key=None, temp=float("-inf"), name="N/A", station=None
+        # When several stations tie on min,max temperature the one with the
+        # lowest key wins, so the result doesn't depend on the order of the
+        # stations
+        min_temp, min_key, min_station = float("+inf"), 0, None
+        max_temp, max_key, max_station = float("-inf"), 0, None
+        # We skip stations that have not been updated lately
+        fresh = [station for station in stations if station.updated >= cutoff_ms]
+        logger.debug(
+            "%s stations ignored as they're not being updated for 2 days",
+            len(stations) - len(fresh),
         )
-        for station in stations:
-            updated = station["updated"]
-            updated = datetime.fromtimestamp(updated // 1000, tz=timezone.utc)
-            update_td = now - updated
-            # TODO check if ignoring data older than 2 days is ok
-            # We skip stations that have not been updated lately
-            if update_td > timedelta(days=2):
-                logger.debug(
-                    "station '%s' ignored as it's not being updated for %s days",
-                    station["name"],
-                    update_td.days,
-                )
-                continue
-            # fetch station data
-            station_data = self.get_station_data(station)
-            if not station_data:
-                # skip if station data is None, due to missing data for the period, etc
-                continue
-            if station_data.temp > max_station.temp:
-                max_station = station_data
-            if station_data.temp < min_station.temp:
-                min_station = station_data
-
-        print(f"Highest temperature: {max_station.name}, {max_station.temp:.1f} degrees")
-        print(f"Lowest temperature: {min_station.name}, {min_station.temp:.1f} degrees")
+
+        # fetch station data concurrently
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            for station_data in ex.map(self.get_station_data, fresh):
+                if not station_data:
+                    # skip if station data is None, due to missing data for the period, etc
+                    continue
+                temp, key = station_data.temp, station_data.key
+                if temp > max_temp or (temp == max_temp and key < max_key):
+                    max_temp, max_key, max_station = temp, key, station_data
+                if temp < min_temp or (temp == min_temp and key < min_key):
+                    min_temp, min_key, min_station = temp, key, station_data
+
+        max_name = max_station.name if max_station else "N/A"
+        min_name = min_station.name if min_station else "N/A"
+        print(f"Highest temperature: {max_name}, {max_temp:.1f} degrees")
+        print(f"Lowest temperature: {min_name}, {min_temp:.1f} degrees")
 
 
 def main():
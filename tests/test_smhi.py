@@ -1,30 +1,92 @@
+import logging
+import threading
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import Mock
 
+import msgspec
+import pytest
 import requests
+from requests.adapters import HTTPAdapter
 
-from smhi.smhi import SmhiParser, StationTemp
+from smhi.smhi import SmhiParser, StationList, StationRow, StationTemp
 
 
 def test_check_connection():
-    parser = SmhiParser()
+    parser = SmhiParser(cache_backend="memory")
     assert 200 == parser.check_connection()
 
 
-def test_parameters(capsys):
+def test_check_connection_bypasses_cache():
+    parser = SmhiParser(cache_backend="memory")
+
+    def _make_request(path):
+        # a cached 200 must not hide that SMHI is unreachable
+        assert parser.session.settings.disabled
+        return Mock(status_code=503)
+
+    parser._make_request = _make_request
+    assert 503 == parser.check_connection()
+
+
+def test_parameters():
     # endoscopic test
     spy = Mock(spec=SmhiParser)
-    spy._make_request(path="/version/1.0").json.return_value = {
-        "resource": [
-            {"key": "20", "title": "param20", "summary": "summary20"},
-            {"key": "10", "title": "param10", "summary": "summary10"},
-        ]
-    }
+    resource = [
+        {"key": "20", "title": "param20", "summary": "summary20"},
+        {"key": "10", "title": "param10", "summary": "summary10"},
+    ]
+    spy._get_json.return_value = {"resource": resource}
     SmhiParser.parameters(spy)
+    # the (cached) response is not modified
+    assert [param["key"] for param in resource] == ["20", "10"]
+
+    # the listing is sorted by key and written with a single print
+    spy.print.assert_called_once_with(
+        " 10, param10 (summary10)\n 20, param20 (summary20)"
+    )
+
+
+def test_get_json_is_memoized():
+    parser = SmhiParser(cache_backend="memory")
+    parser._make_request = Mock()
+    parser._make_request.return_value.status_code = 200
+    parser._make_request.return_value.content = b'{"resource": []}'
+
+    assert parser._get_json(path="/version/1.0.json") == {"resource": []}
+    assert parser._get_json(path="/version/1.0.json") == {"resource": []}
+    # the second call is served from the in-memory cache
+    parser._make_request.assert_called_once_with(path="/version/1.0.json")
+
+
+def test_get_json_failures_are_not_memoized():
+    parser = SmhiParser(cache_backend="memory")
+    parser._make_request = Mock()
+    parser._make_request.return_value.status_code = 503
+
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            parser._get_json(path="/version/1.0.json")
+    assert parser._make_request.call_count == 2
 
-    captured = capsys.readouterr()
-    assert "10, param10 (summary10)" in captured.out
-    assert "20, param20 (summary20)" in captured.out
+
+@pytest.mark.parametrize(
+    "status_code,body,exception",
+    [
+        (503, b"", requests.HTTPError),
+        (200, b"<html>Bad Gateway</html>", msgspec.DecodeError),
+    ],
+)
+def test_temperatures_station_list_unavailable(capsys, status_code, body, exception):
+    # without the station list the scan fails, so the CLI exits non-zero
+    parser = SmhiParser(cache_backend="memory")
+    parser._make_request = Mock()
+    parser._make_request.return_value.status_code = status_code
+    parser._make_request.return_value.content = body
+
+    with pytest.raises(exception):
+        parser.temperatures_parameter_2()
+    assert capsys.readouterr().out == ""
 
 
 def test_temperatures_only_one_station(capsys):
@@ -32,17 +94,20 @@ def test_temperatures_only_one_station(capsys):
     # all the collaborator methods in the class are mocked
     spy = Mock(spec=SmhiParser)
 
-    spy._make_request(path="/version/1.0/parameter/2").json.return_value = {
-        "station": [
-            {
-                "updated": datetime.now().timestamp() * 1000,
-                "key": "1",
-                "name": "stationA",
-            },
-        ],
-    }
+    spy._get_json.return_value = msgspec.convert(
+        {
+            "station": [
+                {
+                    "updated": int(datetime.now().timestamp() * 1000),
+                    "key": "1",
+                    "name": "stationA",
+                },
+            ],
+        },
+        StationList,
+    )
     spy.get_station_data.return_value = StationTemp(
-        key="1", temp=-99, name="stationA", station=None
+        key=1, temp=-99, name="stationA", station=None
     )
     SmhiParser.temperatures_parameter_2(spy)
 
@@ -56,21 +121,24 @@ def test_temperatures_only_two_stations(capsys):
     # all the collaborator methods in the class are mocked
     spy = Mock(spec=SmhiParser)
 
-    spy._make_request(path="/version/1.0/parameter/2").json.return_value = {
-        "station": [
-            {
-                "updated": datetime.now().timestamp() * 1000,
-                "key": "1",
-            },
-            {
-                "updated": datetime.now().timestamp() * 1000,
-                "key": "2",
-            },
-        ],
-    }
+    spy._get_json.return_value = msgspec.convert(
+        {
+            "station": [
+                {
+                    "updated": int(datetime.now().timestamp() * 1000),
+                    "key": "1",
+                },
+                {
+                    "updated": int(datetime.now().timestamp() * 1000),
+                    "key": "2",
+                },
+            ],
+        },
+        StationList,
+    )
     spy.get_station_data.side_effect = [
-        StationTemp(key="1", temp=-99, name="stationA", station=None),
-        StationTemp(key="2", temp=99, name="stationB", station=None),
+        StationTemp(key=1, temp=-99, name="stationA", station=None),
+        StationTemp(key=2, temp=99, name="stationB", station=None),
     ]
     SmhiParser.temperatures_parameter_2(spy)
 
@@ -80,32 +148,32 @@ def test_temperatures_only_two_stations(capsys):
 
 
 def test_temperatures_integration(capsys):
-    parser = SmhiParser()
+    parser = SmhiParser(cache_backend="memory")
 
     def _make_request(path=""):
         # mock
         mock = Mock(spec=requests.Response)
         mock.status_code = 200
         match path:
-            case "/version/1.0/parameter/2":
-                mock.json.return_value = {
+            case "/version/1.0/parameter/2.json":
+                body = {
                     "station": [
                         {
-                            "updated": datetime.now().timestamp() * 1000,
+                            "updated": int(datetime.now().timestamp() * 1000),
                             "key": "3",
                         },
                         {
-                            "updated": datetime.now().timestamp() * 1000,
+                            "updated": int(datetime.now().timestamp() * 1000),
                             "key": "1",
                         },
                         {
-                            "updated": datetime.now().timestamp() * 1000,
+                            "updated": int(datetime.now().timestamp() * 1000),
                             "key": "2",
                         },
                     ],
                 }
-            case "/version/1.0/parameter/2/station/3/period/latest-day/data":
-                mock.json.return_value = {
+            case "/version/1.0/parameter/2/station/3/period/latest-day/data.json":
+                body = {
                     "station": {
                         "key": "3",
                         "name": "station3",
@@ -116,8 +184,8 @@ def test_temperatures_integration(capsys):
                         }
                     ],
                 }
-            case "/version/1.0/parameter/2/station/2/period/latest-day/data":
-                mock.json.return_value = {
+            case "/version/1.0/parameter/2/station/2/period/latest-day/data.json":
+                body = {
                     "station": {
                         "key": "2",
                         "name": "station2",
@@ -128,8 +196,8 @@ def test_temperatures_integration(capsys):
                         }
                     ],
                 }
-            case "/version/1.0/parameter/2/station/1/period/latest-day/data":
-                mock.json.return_value = {
+            case "/version/1.0/parameter/2/station/1/period/latest-day/data.json":
+                body = {
                     "station": {
                         "key": "1",
                         "name": "station1",
@@ -143,6 +211,7 @@ def test_temperatures_integration(capsys):
             case _:
                 raise Exception(f"this should not happen. path = {path}")
 
+        mock.content = msgspec.json.encode(body)
         return mock
 
     parser._make_request = _make_request
@@ -153,5 +222,148 @@ def test_temperatures_integration(capsys):
     assert "Lowest temperature: station3, 10.0 degrees" in captured.out
 
 
-# TODO: test stations with same temperature
-# TODO: test invalid data is skipped, 404, missing value, value = [], value.value = unparseable string
+def test_temperatures_tie_lowest_key_wins(capsys):
+    # endoscopic test, stations with the same temperature are reported
+    # deterministically regardless of the order of the station list
+    spy = Mock(spec=SmhiParser)
+
+    spy._get_json.return_value = msgspec.convert(
+        {
+            "station": [
+                {"updated": int(datetime.now().timestamp() * 1000), "key": key}
+                for key in ["30", "4", "20"]
+            ],
+        },
+        StationList,
+    )
+    spy.get_station_data.side_effect = lambda station: StationTemp(
+        key=int(station.key), temp=5, name=f"station{station.key}", station=None
+    )
+    SmhiParser.temperatures_parameter_2(spy)
+
+    captured = capsys.readouterr()
+    assert "Highest temperature: station4, 5.0 degrees" in captured.out
+    assert "Lowest temperature: station4, 5.0 degrees" in captured.out
+
+
+def test_temperatures_station_timeout_is_skipped(capsys):
+    parser = SmhiParser(cache_backend="memory")
+    now = int(datetime.now().timestamp() * 1000)
+
+    def _make_request(path=""):
+        mock = Mock(spec=requests.Response)
+        mock.status_code = 200
+        match path:
+            case "/version/1.0/parameter/2.json":
+                body = {
+                    "station": [
+                        {"updated": now, "key": "1"},
+                        {"updated": now, "key": "2"},
+                        {"updated": now, "key": "3"},
+                    ],
+                }
+            case "/version/1.0/parameter/2/station/2/period/latest-day/data.json":
+                raise requests.Timeout("read timed out")
+            case _:
+                key = path.split("/")[6]
+                body = {
+                    "station": {"key": key, "name": f"station{key}"},
+                    "value": [{"value": key}],
+                }
+        mock.content = msgspec.json.encode(body)
+        return mock
+
+    parser._make_request = _make_request
+    parser.temperatures_parameter_2()
+
+    captured = capsys.readouterr()
+    assert "Highest temperature: station3, 3.0 degrees" in captured.out
+    assert "Lowest temperature: station1, 1.0 degrees" in captured.out
+
+
+@pytest.mark.parametrize(
+    "status_code,body",
+    [
+        (404, b""),
+        (200, b'{"station": {"key": "1", "name": "station1"}}'),
+        (200, b'{"station": {"key": "1", "name": "station1"}, "value": null}'),
+        (200, b'{"station": {"key": "1", "name": "station1"}, "value": []}'),
+        (200, b'{"station": {"key": "1", "name": "station1"}, "value": [{}]}'),
+        (
+            200,
+            b'{"station": {"key": "1", "name": "station1"}, "value": [{"value": "x"}]}',
+        ),
+        (200, b'{"value": [{"value": "1.0"}]}'),
+        (200, b"<html>Bad Gateway</html>"),
+        (200, b'{"station": {"key": "1", "name": "stat'),
+        (200, b'{"station": {"key": "x", "name": "x"}, "value": [{"value": "1.0"}]}'),
+    ],
+)
+def test_get_station_data_invalid_data_is_skipped(status_code, body):
+    parser = SmhiParser(cache_backend="memory")
+    parser._make_request = Mock()
+    parser._make_request.return_value.status_code = status_code
+    parser._make_request.return_value.content = body
+
+    assert parser.get_station_data(StationRow(key="1", updated=0)) is None
+
+
+def test_get_station_data_not_found_is_not_a_warning(caplog):
+    # stations without data for the period are common, they are only
+    # logged at debug level
+    parser = SmhiParser(cache_backend="memory")
+    parser._make_request = Mock()
+    parser._make_request.return_value.status_code = 404
+
+    assert parser.get_station_data(StationRow(key="1", updated=0)) is None
+    assert not [r for r in caplog.records if r.levelno >= logging.WARNING]
+
+
+def test_temperatures_station_with_server_errors_is_skipped(capsys):
+    # station 2 keeps answering 503, once the session retries are exhausted
+    # the station is skipped instead of aborting the whole scan
+    now = int(datetime.now().timestamp() * 1000)
+    bodies = {
+        "/version/1.0/parameter/2.json": msgspec.json.encode(
+            {"station": [{"updated": now, "key": "1"}, {"updated": now, "key": "2"}]}
+        ),
+        "/version/1.0/parameter/2/station/1/period/latest-day/data.json": msgspec.json.encode(
+            {"station": {"key": "1", "name": "station1"}, "value": [{"value": "1.0"}]}
+        ),
+    }
+
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            body = bodies.get(self.path)
+            self.send_response(200 if body else 503)
+            self.end_headers()
+            self.wfile.write(body or b"")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    ).start()
+    try:
+        parser = SmhiParser(cache_backend="memory")
+        parser.BASE_URL = f"http://127.0.0.1:{server.server_port}"
+        # same retries as for https, but without the backoff sleeps
+        retries = parser.session.get_adapter("https://").max_retries
+        parser.session.mount(
+            "http://", HTTPAdapter(max_retries=retries.new(backoff_factor=0))
+        )
+        parser.temperatures_parameter_2()
+    finally:
+        server.shutdown()
+
+    captured = capsys.readouterr()
+    assert "Highest temperature: station1, 1.0 degrees" in captured.out
+    assert "Lowest temperature: station1, 1.0 degrees" in captured.out
+    # station 2 was retried before giving up
+    station2 = "/version/1.0/parameter/2/station/2/period/latest-day/data.json"
+    assert requested.count(station2) > 1